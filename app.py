@@ -5,9 +5,10 @@ import re
 import io
 import json
 import csv
-import tempfile
 import mimetypes
 import zipfile
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from PyPDF2 import PdfReader, PdfWriter
 
@@ -15,6 +16,8 @@ from PyPDF2 import PdfReader, PdfWriter
 import pickle
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseUpload
 
@@ -24,14 +27,22 @@ CREDENTIALS_FILE = "credentials.json"
 TOKEN_FILE = "token.pickle"
 
 PROGRESS_LOG = "progress_log.json"
+PROGRESS_SAVE_INTERVAL = 25
 SUMMARY_JSON = "Run_Summary.json"
 SUMMARY_CSV = "Run_Summary.csv"
 
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 
+UPLOAD_WORKERS = 8
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Smaller files go up in a single multipart request
+RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+UPLOAD_RETRIES = 3
+
 
 # ---------------- Auth ----------------
-def authenticate_google_drive():
+@st.cache_resource
+def get_drive_credentials():
     creds = None
     if os.path.exists(TOKEN_FILE):
         with open(TOKEN_FILE, "rb") as f:
@@ -44,53 +55,195 @@ def authenticate_google_drive():
             creds = flow.run_local_server(port=0)
         with open(TOKEN_FILE, "wb") as token:
             pickle.dump(creds, token)
-    return build("drive", "v3", credentials=creds)
+    return creds
+
+
+@st.cache_resource
+def authenticate_google_drive():
+    return build("drive", "v3", credentials=get_drive_credentials())
+
 
+# httplib2.Http is not thread-safe: the cached service is shared, but each
+# request is executed on a transport that only one thread uses at a time
+def authorized_http(creds):
+    return AuthorizedHttp(creds, http=httplib2.Http())
 
-def find_file_in_folder(service, filename, folder_id):
-    safe_name = filename.replace("'", "\\'")
-    q = f"name = '{safe_name}' and '{folder_id}' in parents and trashed = false"
-    res = service.files().list(q=q, spaces='drive', fields='files(id,name)', pageSize=1).execute()
-    files = res.get('files', [])
-    return files[0] if files else None
 
+def list_folder_files(service, http, folder_id):
+    q = f"'{folder_id}' in parents and trashed = false"
+    files, page_token = {}, None
+    while True:
+        res = service.files().list(q=q, spaces='drive', fields='nextPageToken, files(id,name)',
+                                   pageSize=1000, pageToken=page_token).execute(http=http)
+        for f in res.get('files', []):
+            files.setdefault(f['name'], f)
+        page_token = res.get('nextPageToken')
+        if not page_token:
+            return files
 
-def upload_or_overwrite(service, filename, file_bytes, mime_type, folder_id, overwrite=False):
+
+def upload_or_overwrite(service, http, filename, file_bytes, mime_type, folder_id, existing_files,
+                        overwrite=False):
     file_metadata = {'name': filename, 'parents': [folder_id]}
-    media = MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype=mime_type, resumable=True)
-    existing = find_file_in_folder(service, filename, folder_id)
+    resumable = len(file_bytes) > RESUMABLE_THRESHOLD
+    media = MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype=mime_type,
+                              resumable=resumable, chunksize=UPLOAD_CHUNK_SIZE)
+    existing = existing_files.get(filename)
     if existing:
         if overwrite:
-            updated = service.files().update(fileId=existing['id'], media_body=media, fields='id').execute()
+            updated = service.files().update(fileId=existing['id'], media_body=media,
+                                             fields='id').execute(http=http, num_retries=UPLOAD_RETRIES)
             return ("overwritten", updated.get('id'))
         else:
             return ("skipped", existing['id'])
     else:
-        created = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+        # A retried multipart create can duplicate a file Drive already
+        # committed; resumable uploads resume the same session instead
+        retries = UPLOAD_RETRIES if resumable else 0
+        created = service.files().create(body=file_metadata, media_body=media,
+                                         fields='id').execute(http=http, num_retries=retries)
         return ("uploaded", created.get('id'))
 
 
+def upload_pdf(service, http_pool, filename, file_bytes, existing_files, overwrite=False):
+    mime_type = mimetypes.guess_type(filename)[0] or "application/pdf"
+    # At most UPLOAD_WORKERS uploads run at once, so a transport is always free
+    http = http_pool.get()
+    try:
+        return upload_or_overwrite(service, http, filename, file_bytes, mime_type,
+                                   GOOGLE_DRIVE_FOLDER_ID, existing_files, overwrite)
+    finally:
+        http_pool.put(http)
+
+
+def skip_page(summary, filename, reason):
+    label = "already done" if reason == "progress log" else reason
+    st.write(f"Skipping ({label}): {filename}")
+    summary["details"]["skipped"].append({"filename": filename, "reason": reason})
+
+
+# Splits the PDF and uploads matched pages while later pages are still being
+# split. Results are recorded on the script thread as each upload finishes;
+# workers only talk to Drive.
+def process_pages(reader, service, creds, existing_files, progress, source_key, overwrite=False):
+    processed = progress[source_key]["processed"]
+    summary = {"details": {"uploaded":[],"overwritten":[],"skipped":[],"failed":[]}}
+    matched_files = []
+    unmatched = 0
+    unsaved = 0
+    total = len(reader.pages)
+    progress_bar = st.progress(0)
+
+    executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+    # One transport per worker, reused across that worker's uploads
+    http_pool = queue.Queue()
+    for _ in range(UPLOAD_WORKERS):
+        http_pool.put(authorized_http(creds))
+    finished = queue.Queue()
+    futures = {}
+    submitted = set()
+    # Copies of a filename waiting on the outcome of the copy being uploaded
+    duplicates = {}
+
+    def submit(filename, file_bytes):
+        future = executor.submit(upload_pdf, service, http_pool, filename, file_bytes,
+                                 existing_files, overwrite)
+        future.add_done_callback(finished.put)
+        futures[future] = filename
+
+    def record_next_result():
+        nonlocal unsaved
+        future = finished.get()
+        filename = futures.pop(future)
+        try:
+            status, file_id = future.result()
+        except Exception as e:
+            summary["details"]["failed"].append({"filename": filename, "error": str(e)})
+            st.error(f"Failed {filename}: {e}")
+            # Retry with the next copy of the same payslip, if any
+            waiting = duplicates.pop(filename)
+            if waiting:
+                duplicates[filename] = waiting[1:]
+                submit(filename, waiting[0])
+            return
+        summary["details"][status].append({
+            "filename": filename,
+            "file_id": file_id,
+            "time": datetime.now(timezone.utc).isoformat()
+        })
+        processed[filename] = status
+        unsaved += 1
+        if unsaved >= PROGRESS_SAVE_INTERVAL:
+            save_progress(progress)
+            unsaved = 0
+        st.write(f"{filename} -> {status}")
+        for _ in duplicates.pop(filename):
+            skip_page(summary, filename, "duplicate in PDF")
+
+    def update_progress_bar():
+        # Every matched page ends up as exactly one summary entry
+        handled = unmatched + sum(len(v) for v in summary["details"].values())
+        if total:
+            progress_bar.progress(handled / total)
+
+    try:
+        for filename, file_bytes, is_matched in split_and_rename_pdf(reader):
+            if not is_matched:
+                unmatched += 1
+            else:
+                matched_files.append((filename, file_bytes))
+                if filename in duplicates:
+                    duplicates[filename].append(file_bytes)
+                elif filename in processed:
+                    skip_page(summary, filename,
+                              "duplicate in PDF" if filename in submitted else "progress log")
+                else:
+                    submitted.add(filename)
+                    duplicates[filename] = []
+                    submit(filename, file_bytes)
+            while not finished.empty():
+                record_next_result()
+            update_progress_bar()
+        while futures:
+            record_next_result()
+            update_progress_bar()
+        executor.shutdown()
+    except BaseException:
+        # Stop, rerun or an error: don't wait for (or keep sending) queued uploads
+        executor.shutdown(wait=False, cancel_futures=True)
+        # Uploads that already reached Drive still go into the progress log
+        for future, filename in futures.items():
+            if future.done() and not future.cancelled() and future.exception() is None:
+                processed[filename] = future.result()[0]
+        raise
+    finally:
+        save_progress(progress)
+    return summary, matched_files
+
+
 # ---------------- PDF Processing ----------------
+YEAR_RE = re.compile(r'\b(20\d{2})\b')
+MONTH_ABBR_RE = re.compile(r'\b(JAN|FEB|MAR|APR|MAY|JUN|JUL|AUG|SEP|OCT|NOV|DEC)-\d{4}\b', re.IGNORECASE)
+IPPIS_RE = re.compile(r'IPPIS\s*Number:\s*(\w+)', re.IGNORECASE)
+
+MONTH_MAP = {'JAN':'01','FEB':'02','MAR':'03','APR':'04','MAY':'05','JUN':'06',
+             'JUL':'07','AUG':'08','SEP':'09','OCT':'10','NOV':'11','DEC':'12'}
+
+
 def get_details_from_text(text):
-    year_match = re.search(r'\b(20\d{2})\b', text)
+    year_match = YEAR_RE.search(text)
     year = year_match.group(1) if year_match else None
-    month_abbr_match = re.search(r'\b(JAN|FEB|MAR|APR|MAY|JUN|JUL|AUG|SEP|OCT|NOV|DEC)-\d{4}\b', text, re.IGNORECASE)
-    if month_abbr_match:
-        month_map = {'JAN':'01','FEB':'02','MAR':'03','APR':'04','MAY':'05','JUN':'06',
-                     'JUL':'07','AUG':'08','SEP':'09','OCT':'10','NOV':'11','DEC':'12'}
-        month = month_map.get(month_abbr_match.group(1).upper())
-    else:
-        month = None
-    ippis_match = re.search(r'IPPIS\s*Number:\s*(\w+)', text, re.IGNORECASE)
+    month_abbr_match = MONTH_ABBR_RE.search(text)
+    month = MONTH_MAP.get(month_abbr_match.group(1).upper()) if month_abbr_match else None
+    ippis_match = IPPIS_RE.search(text)
     ippis_number = ippis_match.group(1) if ippis_match else None
     if year and month and ippis_number:
         return {'year': year, 'month': month, 'ippis_number': ippis_number}
     return None
 
 
-def split_and_rename_pdf(input_pdf_path):
-    all_files, matched_files = [], []
-    reader = PdfReader(input_pdf_path)
+# Yields pages as they are split so callers can start uploading straight away
+def split_and_rename_pdf(reader):
     for i, page in enumerate(reader.pages):
         writer = PdfWriter()
         writer.add_page(page)
@@ -104,12 +257,7 @@ def split_and_rename_pdf(input_pdf_path):
             is_matched = False
         buf = io.BytesIO()
         writer.write(buf)
-        buf.seek(0)
-        file_bytes = buf.read()
-        all_files.append((filename, file_bytes))
-        if is_matched:
-            matched_files.append((filename, file_bytes))
-    return all_files, matched_files
+        yield filename, buf.getvalue(), is_matched
 
 
 # ---------------- Progress & Summary ----------------
@@ -164,51 +312,24 @@ if uploaded_file:
     st.success(f"Uploaded: {uploaded_file.name}")
 
     if st.button("Process & Upload"):
+        pdf_bytes = uploaded_file.getvalue()
         progress = load_progress()
-        source_key = f"{uploaded_file.name}::{len(uploaded_file.getvalue())}"
+        source_key = f"{uploaded_file.name}::{len(pdf_bytes)}"
         if source_key not in progress:
             progress[source_key] = {"processed": {}}
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            tmp.write(uploaded_file.getvalue())
-            tmp_path = tmp.name
-
-        all_files, matched_files = split_and_rename_pdf(tmp_path)
+        creds = get_drive_credentials()
         service = authenticate_google_drive()
+        # One listing up front instead of a name lookup per uploaded file
+        try:
+            existing_files = list_folder_files(service, authorized_http(creds), GOOGLE_DRIVE_FOLDER_ID)
+        except Exception as e:
+            st.error(f"Failed to list Drive folder: {e}")
+            st.stop()
 
-        summary = {"details": {"uploaded":[],"overwritten":[],"skipped":[],"failed":[]}}
-
-        # Progress bar
-        progress_bar = st.progress(0)
-        total = len(matched_files)
-        for idx, (filename, file_bytes) in enumerate(matched_files, 1):
-            if filename in progress[source_key]["processed"]:
-                st.write(f"Skipping (already done): {filename}")
-                summary["details"]["skipped"].append({"filename": filename, "reason":"progress log"})
-                progress_bar.progress(idx / total)
-                continue
-            try:
-                mime_type = mimetypes.guess_type(filename)[0] or "application/pdf"
-                status, file_id = upload_or_overwrite(
-                    service, filename, file_bytes, mime_type,
-                    GOOGLE_DRIVE_FOLDER_ID, overwrite_toggle
-                )
-                entry = {
-                    "filename": filename,
-                    "file_id": file_id,
-                    "time": datetime.now(timezone.utc).isoformat()
-                }
-                summary["details"][status].append(entry)
-                progress[source_key]["processed"][filename] = status
-                save_progress(progress)
-                st.write(f"{filename} -> {status}")
-            except Exception as e:
-                summary["details"]["failed"].append({
-                    "filename": filename,
-                    "error": str(e)
-                })
-                st.error(f"Failed {filename}: {e}")
-            progress_bar.progress(idx / total)
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        summary, matched_files = process_pages(reader, service, creds, existing_files,
+                                               progress, source_key, overwrite_toggle)
 
         counts = {k:len(v) for k,v in summary["details"].items()}
         summary["meta"] = {
@@ -229,7 +350,7 @@ if uploaded_file:
         if matched_files:
             st.subheader("Download Matched Files (ZIP)")
             zip_buf = io.BytesIO()
-            with zipfile.ZipFile(zip_buf, "w", zipfile.ZIP_DEFLATED) as zf:
+            with zipfile.ZipFile(zip_buf, "w", zipfile.ZIP_STORED) as zf:
                 for filename, file_bytes in matched_files:
                     zf.writestr(filename, file_bytes)
             zip_buf.seek(0)